@@ -8,14 +8,46 @@ The relevant functions are:
 """
 
 import os
-from time import sleep
+import re
+import atexit
+import functools
+from time import sleep, monotonic
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging as log
-from typing import Callable, List, Tuple
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from typing import Callable, List, Tuple, Union
 from PIL import Image
 import gphoto2 as gp
 
+# Camera kept open across captures, see `get_camera`
+_camera = None
+# Errors that mean the camera was turned off or disconnected
+CAMERA_LOST_ERRORS = (
+    gp.GP_ERROR_IO,
+    gp.GP_ERROR_IO_INIT,
+    gp.GP_ERROR_IO_READ,
+    gp.GP_ERROR_IO_WRITE,
+    gp.GP_ERROR_IO_UPDATE,
+    gp.GP_ERROR_IO_USB_CLEAR_HALT,
+    gp.GP_ERROR_IO_USB_FIND,
+    gp.GP_ERROR_IO_USB_CLAIM,
+    gp.GP_ERROR_IO_LOCK,
+    gp.GP_ERROR_MODEL_NOT_FOUND,
+)
+# libgphoto2 is not thread safe, hold this lock when using the camera
+_camera_lock = threading.Lock()
+# Worker threads for downloading images and running the countdown handler.
+# They have separate pools so a countdown never waits for the downloader
+_download_pool = ThreadPoolExecutor(max_workers=1,
+                                    thread_name_prefix='download')
+_countdown_pool = ThreadPoolExecutor(max_workers=1,
+                                     thread_name_prefix='countdown')
+atexit.register(_download_pool.shutdown, wait=False)
+atexit.register(_countdown_pool.shutdown, wait=False)
+
 
 def open_camera() -> gp.Camera:
     """
@@ -31,69 +63,340 @@ def open_camera() -> gp.Camera:
         return None
 
 
+def set_config(camera: gp.Camera, name: str, value: Union[int, str]) -> bool:
+    """
+    Set the camera config widget `name` to `value`. If `value` is an int it is
+    used as the index of the choice to set.
+    Return False if the camera does not have the widget or value.
+    """
+    try:
+        config = camera.get_config()
+        widget = config.get_child_by_name(name)
+        if isinstance(value, int):
+            value = widget.get_choice(value)
+        widget.set_value(value)
+        camera.set_config(config)
+    except gp.GPhoto2Error as err:
+        log.warning('%s, could not set camera config %s', err, name)
+        return False
+    log.debug('Set camera config %s to %s', name, value)
+    return True
+
+
+def find_medium_choice(choices: List[str]) -> str:
+    """
+    Return the choice for medium size jpeg images, like "Medium Fine JPEG" or
+    the middle of the "WxH" sizes. Return None if there is no such choice.
+    """
+    medium = [
+        choice for choice in choices
+        if 'medium' in choice.lower() and 'raw' not in choice.lower()
+    ]
+    if medium:
+        fine = [choice for choice in medium if 'fine' in choice.lower()]
+        return (fine or medium)[0]
+
+    sizes = []
+    for choice in choices:
+        match = re.fullmatch(r'\s*(\d+)\s*x\s*(\d+)\s*', choice)
+        if match:
+            sizes.append((int(match[1]) * int(match[2]), choice))
+    if len(sizes) > 1:
+        sizes.sort()
+        return sizes[(len(sizes) - 1) // 2][1]
+    return None
+
+
+def set_medium_image_size(camera: gp.Camera) -> bool:
+    """
+    Set the camera to capture medium size jpeg images, with the `imagesize`
+    or `imageformat` config. Return False if the camera has no such choice.
+    """
+    try:
+        config = camera.get_config()
+    except gp.GPhoto2Error as err:
+        log.warning('%s, could not read camera config', err)
+        return False
+
+    for name in ('imagesize', 'imageformat'):
+        # Skip missing widgets and widgets without choices
+        try:
+            widget = config.get_child_by_name(name)
+            choices = list(widget.get_choices())
+        except gp.GPhoto2Error:
+            continue
+        value = find_medium_choice(choices)
+        if value is not None:
+            return set_config(camera, name, value)
+
+    log.debug('Camera has no medium image size, capturing full size images')
+    return False
+
+
+def get_camera() -> gp.Camera:
+    """
+    Return the camera session, opening it with `open_camera` on first use.
+    The camera is kept open between captures and closed when the program
+    exits. Return None if no camera was available.
+    """
+    global _camera
+    # Hold the lock so the camera is only opened once, even if this is
+    # called from several threads at the same time
+    with _camera_lock:
+        if _camera is None:
+            _camera = open_camera()
+            if _camera is not None:
+                # Store captures on the memory card instead of the camera RAM
+                set_config(_camera, 'capturetarget', 1)
+                # Capture smaller images, they are scaled down for the montage
+                # anyway. Full size images are captured if not supported
+                set_medium_image_size(_camera)
+        return _camera
+
+
+def close_camera() -> None:
+    """
+    Close the camera session, the next `get_camera` call opens it again.
+    """
+    global _camera
+    with _camera_lock:
+        if _camera is None:
+            return
+        try:
+            _camera.exit()
+        except gp.GPhoto2Error as err:
+            log.warning('%s, could not close camera', err)
+        _camera = None
+
+
+atexit.register(close_camera)
+
+
+def trigger_capture(camera: gp.Camera,
+                    timeout: float = 10) -> gp.CameraFilePath:
+    """
+    Trigger the camera shutter and wait until the capture is complete.
+    Return the path of the captured jpeg file on the camera. Other files,
+    like raw files, and events from before the capture are ignored.
+    """
+    deadline = monotonic() + timeout
+    with _camera_lock:
+        # Discard events left over from earlier, like manual shutter presses
+        while monotonic() < deadline:
+            event_type, event_data = camera.wait_for_event(10)
+            if event_type == gp.GP_EVENT_TIMEOUT:
+                break
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                log.debug('Ignoring earlier file %s', event_data.name)
+        gp.check_result(gp.gp_camera_trigger_capture(camera))
+
+    # Wait until the capture is complete, or no more events arrive after
+    # the jpeg file is added
+    file_path = None
+    while monotonic() < deadline:
+        with _camera_lock:
+            event_type, event_data = camera.wait_for_event(100)
+        if event_type == gp.GP_EVENT_FILE_ADDED:
+            if event_data.name.lower().endswith(('.jpg', '.jpeg')):
+                file_path = event_data
+            else:
+                log.debug('Ignoring captured file %s', event_data.name)
+        elif event_type == gp.GP_EVENT_CAPTURE_COMPLETE:
+            break
+        elif event_type == gp.GP_EVENT_TIMEOUT and file_path is not None:
+            break
+
+    if file_path is None:
+        raise gp.GPhoto2Error(gp.GP_ERROR_TIMEOUT)
+    return file_path
+
+
+def shrink_image(path: str, max_size: Tuple[int, int]) -> str:
+    """
+    Save a copy of the image in path scaled down to fit inside `max_size`,
+    keeping the exif data, and return the path of the copy. The original
+    image is kept. Return path if the image already fits.
+    """
+    with Image.open(path) as img:
+        if img.width <= max_size[0] and img.height <= max_size[1]:
+            return path
+        img.draft('RGB', max_size)
+        img.thumbnail(max_size, Image.BILINEAR)
+        small_path = os.path.splitext(path)[0] + '_small.jpg'
+        img.save(small_path,
+                 'JPEG',
+                 quality=88,
+                 exif=img.info.get('exif', b''))
+    return small_path
+
+
+def download_images(camera: gp.Camera,
+                    file_queue: queue.Queue,
+                    image_paths: List[str],
+                    max_size: Tuple[int, int] = None) -> bool:
+    """
+    Download files from the camera until None is read from `file_queue`.
+    Each item in the queue is a tuple of the file path on the camera and
+    the path to save the file in. Saved paths are appended to `image_paths`.
+    Use `max_size` to append the paths of scaled down copies instead.
+    Return True if the connection to the camera was lost.
+    """
+    camera_lost = False
+    while True:
+        item = file_queue.get()
+        if item is None:
+            break
+        file_path, path = item
+
+        # Get image from camera
+        try:
+            with _camera_lock:
+                camera_file = camera.file_get(file_path.folder,
+                                              file_path.name,
+                                              gp.GP_FILE_TYPE_NORMAL)
+        except gp.GPhoto2Error as e:
+            log.error('%s, could not get file %s in %s from camera', e,
+                      file_path.name, file_path.folder)
+            camera_lost = camera_lost or e.code in CAMERA_LOST_ERRORS
+            continue
+
+        # Save file without holding the camera lock, so the next capture
+        # can be triggered while writing to disk
+        try:
+            camera_file.save(path)
+        except (gp.GPhoto2Error, OSError) as e:
+            log.error('%s, could not save capture in %s', e, path)
+            continue
+        log.info('Saved capture in %s', path)
+
+        # Use a scaled down copy, and keep the full size capture
+        if max_size is not None:
+            try:
+                path = shrink_image(path, max_size)
+            except OSError as e:
+                log.warning('%s, could not scale down capture %s', e, path)
+        image_paths.append(path)
+
+    return camera_lost
+
+
+def run_countdown(countdown_handler: Callable[[int], None],
+                  wait_time: int) -> None:
+    """
+    Run `countdown_handler` with `wait_time` and log any exception, since
+    exceptions are not shown when running in the thread pool.
+    """
+    try:
+        countdown_handler(wait_time)
+    except Exception:
+        log.exception('Countdown handler failed')
+
+
 def capture_images(
         camera: gp.Camera,
         n_images: int = 4,
         wait_time: int = 0,
         outdir: str = 'output',
-        countdown_handler: Callable[[int], None] = None) -> List[str]:
+        countdown_handler: Callable[[int], None] = None,
+        max_size: Tuple[int, int] = None,
+        timestamp: str = None) -> List[str]:
     """
     Capture and download images with a camera and return the paths of each 
-    image in a list.
+    image in a list. The camera is not closed after capturing, unless it is
+    the camera from `get_camera` and the connection to it was lost.
     Use `countdown_handler` to specify a handler function called when sleeping 
     before image capture. The `wait_time` argument will be added as an
     argument to `countdown_handler`.
+    Use `max_size` to return paths of copies of the downloaded images scaled
+    down to fit inside it. The full size images are kept.
+    The images are named with `timestamp`, or the current time if it is None.
     """
-    # Capture n images
+    # Download images in a separate thread while capturing the next one
     image_paths = []
-    for i in range(n_images):
-        # Sleep if specified
-        if wait_time > 0:
-            log.debug('Waiting %d s before capture', wait_time)
-            # Start countdown handler in thread
-            if callable(countdown_handler):
-                threading.Thread(target=countdown_handler,
-                                 args=(wait_time, )).start()
-            sleep(wait_time)
-
-        log.debug('Capturing image %d of %d', i + 1, n_images)
-        # Capture image
-        try:
-            file_path = camera.capture(gp.GP_CAPTURE_IMAGE)
-        except gp.GPhoto2Error as e:
-            log.error('Could not capture image, %s', e)
-            continue
+    file_queue = queue.Queue()
+    downloader = _download_pool.submit(download_images, camera, file_queue,
+                                       image_paths, max_size)
 
-        # Get image from camera
-        try:
-            camera_file = camera.file_get(file_path.folder, file_path.name,
-                                          gp.GP_FILE_TYPE_NORMAL)
-        except gp.GPhoto2Error as e:
-            log.error('%s, could not get file %s in %s from camera', e,
-                      file_path.name, file_path.folder)
-            continue
+    # Capture n images, all named with the same timestamp
+    if timestamp is None:
+        timestamp = datetime.now().strftime(r'%y-%m-%d_%H-%M-%S')
+    camera_lost = False
+    try:
+        for i in range(n_images):
+            # Sleep if specified
+            if wait_time > 0:
+                log.debug('Waiting %d s before capture', wait_time)
+                # Start countdown handler in worker thread
+                if callable(countdown_handler):
+                    _countdown_pool.submit(run_countdown, countdown_handler,
+                                           wait_time)
+                sleep(wait_time)
 
-        # Save file
-        filename = datetime.now().strftime(
-            r'%y-%m-%d_%H-%M-%S') + f'_capture-{i}.jpg'
-        path = os.path.join(outdir, filename)
-        camera_file.save(path)
-        image_paths.append(path)
-        log.info('Saved capture in %s', path)
+            log.debug('Capturing image %d of %d', i + 1, n_images)
+            # Capture image
+            try:
+                file_path = trigger_capture(camera)
+            except gp.GPhoto2Error as e:
+                log.error('Could not capture image, %s', e)
+                if e.code in CAMERA_LOST_ERRORS:
+                    camera_lost = True
+                    break
+                continue
+
+            # Queue image for download
+            path = os.path.join(outdir, f'{timestamp}_capture-{i}.jpg')
+            file_queue.put((file_path, path))
+    finally:
+        # Always stop the downloader, even if capturing failed
+        file_queue.put(None)
+
+    # Wait for the remaining downloads
+    camera_lost = downloader.result() or camera_lost
 
-    camera.exit()
+    # Close the camera session so it is opened again on the next capture.
+    # Other cameras are left for the caller to close
+    if camera_lost:
+        log.warning('Lost connection to camera')
+        if camera is _camera:
+            close_camera()
     return image_paths
 
 
+def decode_and_resize(path: str, max_size: Tuple[int, int],
+                      aspect_ratio: float) -> Image:
+    """
+    Read image in path and resize it to fit inside `max_size` while keeping
+    its aspect ratio. `aspect_ratio` decides if the width or height is fitted.
+    """
+    max_w, max_h = max_size
+    with Image.open(path) as img:
+        # Calculate new size with correct aspect ratio
+        img_w, img_h = img.size
+        img_ar = img_w / img_h
+        if img_ar > aspect_ratio:
+            new_size = (max_w, int(max_w / img_ar))
+        else:
+            new_size = (int(max_h * img_ar), max_h)
+
+        # Let the jpeg decoder scale down the image as close to the new size
+        # as possible while decoding, then resize the rest of the way. Large
+        # reductions are done with a box filter first, see `reducing_gap`
+        img.draft('RGB', new_size)
+        img = img.resize(new_size, Image.BILINEAR, reducing_gap=3.0)
+
+    # Use the same mode as the base image so pasting is a plain copy
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
 def paste_images(base_image: Image, paths: List[str],
                  shape: Tuple[int, int]) -> Image:
     """
-    Calculate position and size for each image in paths and paste it on base_image
+    Calculate position and size for each image in paths and paste it on base_image.
+    The base image should already be rotated if there are more columns than rows.
     """
-    # Rotate if there are more columns than rows
     rows, cols = shape
-    if cols > rows:
-        base_image = base_image.rotate(90, expand=True)
 
     # Calculate width, height, aspect ratio and border offset
     width, height = base_image.size
@@ -102,31 +405,38 @@ def paste_images(base_image: Image, paths: List[str],
     max_img_h = int((height - (cols + 1) * offset) / cols)
     aspect_ratio = width / height
 
-    # Go through all image files
-    for i, path in enumerate(paths):
-        # Read image and put it on base image
-        with Image.open(path) as img:
-            # Resize with correct aspect ratio
-            img_w, img_h = img.size
-            img_ar = img_w / img_h
-            if img_ar > aspect_ratio:
-                new_size = (max_img_w, int(max_img_w / img_ar))
-            else:
-                new_size = (int(max_img_h * img_ar), max_img_h)
-
-            img = img.resize(new_size)
-
-            # Calculate x and y offset values
-            img_w, img_h = img.size
+    # Calculate position of each image
+    positions = [(offset + (i % rows) * (max_img_w + offset),
+                  offset + (i // rows) * (max_img_h + offset))
+                 for i in range(len(paths))]
 
+    # Decode and resize images in parallel, but paste them in this thread
+    # since pasting is not thread safe. Use at most one worker per cpu, so
+    # no more full size images than cpus are decoded at the same time
+    n_workers = min(len(paths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        images = executor.map(decode_and_resize, paths,
+                              [(max_img_w, max_img_h)] * len(paths),
+                              [aspect_ratio] * len(paths))
+        for img, position in zip(images, positions):
             # Paste image onto base image
-            pos_x = offset + (i % rows) * (max_img_w + offset)
-            pos_y = offset + (i // rows) * (max_img_h + offset)
-            base_image.paste(img, (pos_x, pos_y))
+            base_image.paste(img, position)
 
     return base_image
 
 
+@functools.lru_cache(maxsize=2)
+def load_background(path: str, rotate: bool = False) -> Image:
+    """
+    Read background image in path and rotate it 90 degrees if `rotate` is set.
+    The result is cached, copy it before modifying it.
+    """
+    background = Image.open(path).convert('RGB')
+    if rotate:
+        background = background.rotate(90, expand=True)
+    return background
+
+
 def create_montage(paths: List[str],
                    dimensions: Tuple[int, int] = (1500, 1000),
                    background: str = None) -> Image:
@@ -136,12 +446,6 @@ def create_montage(paths: List[str],
     Use `background` to set background image, or use `dimensions` to use a 
     white background image of the dimensions.
     """
-    # Create base image
-    if background is None:
-        base_image = Image.new('RGB', dimensions, color=(255, 255, 255))
-    else:
-        base_image = Image.open(background)
-
     # Check that the amount images is supported in layout
     n_images = len(paths)
     n_image_layout = {
@@ -154,7 +458,17 @@ def create_montage(paths: List[str],
                   n_images, str(n_image_layout.keys()))
         return None
 
-    return paste_images(base_image, paths, n_image_layout[n_images])
+    # Create base image, rotated if there are more columns than rows
+    rows, cols = n_image_layout[n_images]
+    rotate = cols > rows
+    if background is None:
+        if rotate:
+            dimensions = dimensions[::-1]
+        base_image = Image.new('RGB', dimensions, color=(255, 255, 255))
+    else:
+        base_image = load_background(background, rotate).copy()
+
+    return paste_images(base_image, paths, (rows, cols))
 
 
 def create_image(
@@ -162,17 +476,22 @@ def create_image(
     background: str = None,
     dimensions: Tuple[int, int] = (1500, 1000),
     countdown_handler: Callable[[int], None] = None,
+    capture_size: Tuple[int, int] = (1600, 1200),
 ) -> str:
     """
     Take photos with `capture_images` command and put them in a montage image.
+    The montage is made from copies of the captured images scaled down to
+    fit inside `capture_size`, use None to use the full size images.
     Returns the path of the montage image.
     """
     # Create output dir if it does not exist
-    if not os.path.isdir(outdir):
-        os.mkdir(outdir)
+    os.makedirs(outdir, exist_ok=True)
+
+    # Name captures and montage with the same timestamp
+    timestamp = datetime.now().strftime(r'%y-%m-%d_%H-%M-%S')
 
-    # Open camera
-    camera = open_camera()
+    # Get camera
+    camera = get_camera()
     if camera is None:
         log.error('No camera available')
         return
@@ -181,7 +500,9 @@ def create_image(
     image_paths = capture_images(camera,
                                  wait_time=2,
                                  outdir=outdir,
-                                 countdown_handler=countdown_handler)
+                                 countdown_handler=countdown_handler,
+                                 max_size=capture_size,
+                                 timestamp=timestamp)
     if len(image_paths) < 1:
         log.error('Got no image paths when capturing images')
         return
@@ -193,13 +514,31 @@ def create_image(
     if image is None:
         log.error('Could not create montage image')
         return
-    filename = datetime.now().strftime(r'%y-%m-%d_%H-%M-%S') + '_montage.jpg'
-    result_image_path = os.path.join(outdir, filename)
-    image.save(result_image_path)
+    result_image_path = os.path.join(outdir, f'{timestamp}_montage.jpg')
+    image.save(result_image_path, 'JPEG', quality=85, optimize=False,
+               progressive=False, subsampling='4:2:0')
     log.info('Saved image montage in %s', result_image_path)
     return result_image_path
 
 
+def setup_logging(level: int = log.INFO, path: str = 'photobooth.log') -> None:
+    """
+    Log to stderr and to the file in `path`. Records are written to the file
+    in batches, except errors which are written right away. The file is
+    rotated when it reaches 1 MB, keeping three old files.
+    """
+    log.basicConfig(format='%(levelname)s: %(message)s', level=level)
+    file_handler = RotatingFileHandler(path,
+                                       maxBytes=1024 * 1024,
+                                       backupCount=3)
+    file_handler.setFormatter(
+        log.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    memory_handler = MemoryHandler(64,
+                                   flushLevel=log.ERROR,
+                                   target=file_handler)
+    log.getLogger().addHandler(memory_handler)
+
+
 def main():
     prompt = 'Press enter to capture photos. Type q and enter to quit\n> '
     while 'q' not in input(prompt).lower():
@@ -207,5 +546,5 @@ def main():
 
 
 if __name__ == '__main__':
-    log.basicConfig(format='%(levelname)s: %(message)s', level=log.INFO)
+    setup_logging()
     main()
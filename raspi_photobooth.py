@@ -9,15 +9,24 @@ from time import sleep, time
 import threading
 import logging as log
 import atexit
+import signal
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from RPi import GPIO
-from photobooth import create_image
+from photobooth import create_image, get_camera, setup_logging
 
 photobooth_mutex = threading.Lock()
 BUTTON = 23
 LED = 24
 PRINTER_MAC = '01:23:45:67:89:AB'
 PRINTER_RES = (int(3.4 * 800), int(2.3 * 800))
+# Worker thread for running the photobox when the button is pressed
+photobox_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photobox')
+# Images are printed one at a time in the background
+print_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='print')
+# PWM used to blink the led during countdown, created in `main`
+led_pwm = None
 
 import logging as log
 import subprocess
@@ -29,9 +38,21 @@ def print_image(path: str, addr: str) -> None:
     `path` is path to image that will be printed.
     `addr` is mac address to bluetooth printer. 
     """
-    command = f'obexftp -S -H -U none -B 4 -b {addr} -p {path}'
-    log.debug('Printing with command: %s', command)
-    subprocess.run(command, shell=True)
+    command = ['obexftp', '-S', '-H', '-U', 'none', '-B', '4', '-b', addr,
+               '-p', path]
+    log.debug('Printing with command: %s', ' '.join(command))
+    try:
+        result = subprocess.run(command,
+                                check=False,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+    except OSError as err:
+        log.error('%s, could not run obexftp', err)
+        return
+
+    if result.returncode != 0:
+        log.error('Could not print %s, obexftp returned %d: %s', path,
+                  result.returncode, result.stderr.decode(errors='replace'))
 
 
 def blink(period: int) -> None:
@@ -46,44 +67,55 @@ def blink(period: int) -> None:
 
 def countdown_handler(wait_time: int) -> None:
     """
-    Blink with increasing frequency before a new image is taken
+    Blink with increasing frequency before a new image is taken.
+    The blinking is done by PWM, so this only updates the frequency.
     """
     max_period = 1
     min_period = 0.05
     start = time()
     time_left = wait_time
-    while time() - start < wait_time:
-        time_left = wait_time - (time() - start)
-        period = time_left / 4
-        if period < min_period:
-            period = min_period
-        elif period > max_period:
-            period = max_period
-
-        blink(period)
+    led_pwm.start(50)
+    try:
+        while time() - start < wait_time:
+            time_left = wait_time - (time() - start)
+            period = time_left / 4
+            if period < min_period:
+                period = min_period
+            elif period > max_period:
+                period = max_period
+
+            led_pwm.ChangeFrequency(1 / period)
+            sleep(0.1)
+    finally:
+        # Stop PWM so `blink` can use the led pin again
+        led_pwm.stop()
 
 
 def run_photobox(mutex: threading.Lock) -> None:
     """
-    Run `create_image` function and release mutex after it is finished
+    Run `create_image` function and release mutex after it is finished.
+    The image is printed in the background after the mutex is released.
     """
     log.debug('Creating photobox image')
+    path = None
     try:
         blink(1)
         path = create_image(countdown_handler=countdown_handler,
                             dimensions=PRINTER_RES)
-        if path is not None:
-            log.debug('Printing image')
-            print_image(path, PRINTER_MAC)
-        else:
-            log.warning('Path to print image is None, could not print image')
-
-        print_image(path, PRINTER_MAC)
         blink(0.1)
         blink(0.1)
+    except Exception:
+        # Exceptions are not shown when running in the thread pool
+        log.exception('Could not create photobox image')
     finally:
         mutex.release()
 
+    if path is not None:
+        log.debug('Printing image')
+        print_pool.submit(print_image, path, PRINTER_MAC)
+    else:
+        log.warning('Path to print image is None, could not print image')
+
 
 def button_handler(_):
     """
@@ -91,15 +123,20 @@ def button_handler(_):
     """
     log.debug('Button pressed')
     if photobooth_mutex.acquire(blocking=False):
-        # Create image in thread
-        threading.Thread(target=run_photobox,
-                         args=(photobooth_mutex, )).start()
+        # Create image in worker thread
+        photobox_pool.submit(run_photobox, photobooth_mutex)
 
     else:  # Don't start a new thread if the previous is still running
         log.debug('Could not start photobooth thread, mutex busy')
 
 
 def main():
+    global led_pwm
+
+    # Open camera before the button is enabled, so it is ready when the
+    # button is pressed and not opened from two threads at once
+    get_camera()
+
     # Setup gpio
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(BUTTON, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -109,17 +146,20 @@ def main():
                           callback=button_handler,
                           bouncetime=100)
     atexit.register(GPIO.cleanup)
+    atexit.register(photobox_pool.shutdown, wait=False)
+    # Exit normally on SIGTERM from `systemctl stop`, so atexit handlers run
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    led_pwm = GPIO.PWM(LED, 1)
 
     # Blink when starting program
     log.debug("Starting program")
     blink(0.1)
     blink(0.1)
 
-    # Run infinite loop
-    while True:
-        sleep(5)
+    # Wait for button presses until the program is stopped by a signal
+    signal.pause()
 
 
 if __name__ == '__main__':
-    log.basicConfig(format='%(levelname)s: %(message)s', level=log.INFO)
+    setup_logging()
     main()